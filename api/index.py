@@ -1,116 +1,608 @@
-from flask import Flask, request, jsonify
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import JSONProvider
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 import os
-import requests
+import httpx
 import itertools
+import functools
+import hashlib
+import orjson
+import re
+import weakref
+import random
+from google.api_core import exceptions as gexc
+from aiolimiter import AsyncLimiter
+import asyncio
+from cachetools import TTLCache
+
+
+
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+
+# Read once at import so a misconfigured deploy fails on startup rather
+# than on its first request.
+GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
+
+SAPLING_KEYS = [
+    key.strip() for key in os.environ["SAPLING_KEYS"].split(",") if key.strip()
+]
+if not SAPLING_KEYS:
+    raise RuntimeError("SAPLING_KEYS must contain at least one key")
+
+# Leave transport at its default: sync clients get "grpc" and async
+# clients "grpc_asyncio", both a single multiplexed HTTP/2 channel per
+# process. Forcing transport="grpc" would hand the async client a
+# blocking channel and stall the event loop on every call.
+genai.configure(api_key=GEMINI_API_KEY)
+
+# Each Sapling lookup takes its own starting offset and walks every key
+# from there, so concurrent lookups spread load without skipping keys.
+sapling_offsets = itertools.cycle(range(len(SAPLING_KEYS)))
+
+SAPLING_URL = "https://api.sapling.ai/api/v1/aidetect"
+
+# One client for the whole process so Sapling calls share pooled
+# keep-alive connections instead of handshaking per request.
+# Connection-level retries cover dropped keep-alive sockets; HTTP errors
+# are still handled by rotating keys in sapling_score().
+sapling_client = httpx.AsyncClient(
+    timeout=10,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        retries=2
+    )
+)
 
+MODEL_REGISTRY = {
+    "flash": "models/gemini-2.5-flash",
+    "pro": "models/gemini-3-flash-preview"
+}
 
+HUMANIZE_MODEL_REGISTRY = {
+    "flash": "models/gemini-2.5-flash",
+    "pro": "models/gemini-3-pro-preview"
+}
 
-app = Flask(__name__)
+MODEL_KEYS = frozenset(MODEL_REGISTRY)
+HUMANIZE_MODEL_KEYS = frozenset(HUMANIZE_MODEL_REGISTRY)
 
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+# Bodies for the common 400s, serialized once rather than per request.
+ERR_NOT_JSON = orjson.dumps({"error": "Request body must be JSON"})
+ERR_MISSING_PROMPT = orjson.dumps({"error": "Missing 'prompt'"})
+ERR_MISSING_CONTENT = orjson.dumps({"error": "Missing 'content'"})
+ERR_INVALID_MODEL = orjson.dumps({
+    "error": "Invalid 'ai_model'",
+    "allowed_values": list(MODEL_REGISTRY)
+})
+ERR_INVALID_HUMANIZE_MODEL = orjson.dumps({
+    "error": "Invalid 'ai_model'",
+    "allowed_values": list(HUMANIZE_MODEL_REGISTRY)
+})
 
-sapling_keys = os.getenv("SAPLING_KEYS", "").split(",")
-sapling_cycle = itertools.cycle(sapling_keys)
 
-MODEL_REGISTRY = {
-    "flash": "models/gemini-2.5-flash",
-    "pro": "models/gemini-3-flash-preview"
-}
+def error_response(body, status=400):
+    return Response(body, status=status, mimetype="application/json")
+
+
+# Used when a "pro" request fails.
+FALLBACK_MODEL = "models/gemini-2.5-flash"
+
+
+@functools.lru_cache(maxsize=8)
+def get_model(model_name):
+    return genai.GenerativeModel(model_name)
+
+
+MAX_PROMPT_CHARS = 32_000
+MAX_CONTEXT_CHARS = 200
+
+# Collapses runs of spaces/tabs but keeps line breaks, which carry
+# paragraph structure the model should preserve. Only for /humanize prose:
+# /generate prompts may hold code or YAML where indentation matters.
+# CRLF is folded to LF first, and a lone \r is left alone as a break too.
+_WS_RE = re.compile(r"[^\S\r\n]+")
+
+
+def normalize_text(text):
+    return _WS_RE.sub(" ", text.replace("\r\n", "\n")).strip()
+
+
+# The humanizer preamble (~600 tokens) is below Gemini's minimum for
+# explicit context caching, so it is sent inline as a system instruction.
+# It always leads the request, which lets Gemini's implicit prefix caching
+# reuse it across calls.
+@functools.lru_cache(maxsize=8)
+def get_instructed_model(model_name, system_instruction):
+    return genai.GenerativeModel(
+        model_name, system_instruction=system_instruction
+    )
+
+
+# Upstream protection: at most GEMINI_MAX_INFLIGHT concurrent calls and
+# GEMINI_RPM calls per minute. Requests that can't get a slot within
+# GEMINI_QUEUE_TIMEOUT seconds are turned away with a 429, and once
+# GEMINI_MAX_QUEUE requests are already waiting, new ones are shed
+# immediately with a 503 instead of piling up behind them.
+#
+# These limits are per worker process; with several workers, set them to
+# the account's quota divided by the worker count.
+GEMINI_MAX_INFLIGHT = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "32"))
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "500"))
+GEMINI_QUEUE_TIMEOUT = 10
+RETRY_AFTER_SECONDS = 5
+
+GEMINI_SEM = asyncio.Semaphore(GEMINI_MAX_INFLIGHT)
+GEMINI_LIMITER = AsyncLimiter(GEMINI_RPM, 60)
+
+gemini_waiting = 0
+
+
+class GeminiBusy(Exception):
+    def __init__(self, status=429):
+        super().__init__(status)
+        self.status = status
+
+
+# Takes one of the GEMINI_SEM slots; the caller must release it with
+# GEMINI_SEM.release() once its Gemini call (or stream) is finished.
+async def acquire_gemini_slot():
+    global gemini_waiting
+
+    if not GEMINI_SEM.locked():
+        # A free slot is taken without yielding, so a burst can't slip
+        # past the queue check below before any slot is actually held.
+        await GEMINI_SEM.acquire()
+    else:
+        if gemini_waiting >= GEMINI_MAX_QUEUE:
+            raise GeminiBusy(503)
+
+        gemini_waiting += 1
+        try:
+            await asyncio.wait_for(GEMINI_SEM.acquire(), GEMINI_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise GeminiBusy(429)
+        finally:
+            gemini_waiting -= 1
+
+    try:
+        await GEMINI_LIMITER.acquire()
+    except BaseException:
+        GEMINI_SEM.release()
+        raise
+
+
+GEMINI_RETRIES = 3
+
+# Errors worth retrying on the same model.
+RETRYABLE_GEMINI_ERRORS = (gexc.ResourceExhausted, gexc.ServiceUnavailable)
+
+# Errors that say the model was unavailable rather than that the request
+# was bad; only these justify re-running a "pro" prompt on FALLBACK_MODEL.
+TRANSIENT_GEMINI_ERRORS = (
+    gexc.ResourceExhausted,
+    gexc.ServiceUnavailable,
+    gexc.DeadlineExceeded,
+    gexc.InternalServerError
+)
+
+
+def should_fall_back(ai_model_key, error):
+    return ai_model_key == "pro" and isinstance(error, TRANSIENT_GEMINI_ERRORS)
+
+
+async def call_gemini(model, prompt, keep_slot=False, **kwargs):
+    # Quota errors and 503s are usually momentary, so retry with jittered
+    # backoff before the caller gives up or falls back to another model.
+    # The backoff sleeps without a slot so waiting doesn't hold one.
+    # With keep_slot the slot stays held on success and the caller must
+    # release it (used by streams, which run long after this returns).
+    for attempt in range(GEMINI_RETRIES):
+        try:
+            await acquire_gemini_slot()
+            try:
+                result = await model.generate_content_async(prompt, **kwargs)
+            except BaseException:
+                GEMINI_SEM.release()
+                raise
+        except RETRYABLE_GEMINI_ERRORS:
+            if attempt == GEMINI_RETRIES - 1:
+                raise
+            await asyncio.sleep(0.2 * 2 ** attempt + random.random() * 0.1)
+            continue
+
+        if not keep_slot:
+            GEMINI_SEM.release()
+        return result
+
+
+# Exact-match cache of Gemini output, keyed on model + full prompt.
+RESPONSE_CACHE = TTLCache(maxsize=10_000, ttl=3600)
+
+# Cache key -> Future of the Gemini call currently producing that entry.
+INFLIGHT = {}
+
+
+async def single_flight(key, coro_factory):
+    fut = INFLIGHT.get(key)
+
+    if fut is None:
+        fut = asyncio.ensure_future(coro_factory())
+        INFLIGHT[key] = fut
+        fut.add_done_callback(lambda _: INFLIGHT.pop(key, None))
+
+    # Shielded so one caller disconnecting doesn't cancel the call for
+    # everyone else waiting on it.
+    return await asyncio.shield(fut)
+
+
+FINISH_REASON_STOP = genai.protos.Candidate.FinishReason.STOP
+
+
+def response_cache_key(model_name, prompt, system_instruction=None):
+    return hashlib.sha256(
+        "|".join((model_name, system_instruction or "", prompt)).encode()
+    ).digest()
+
+
+async def cached_generate(model_name, prompt, system_instruction=None):
+    key = response_cache_key(model_name, prompt, system_instruction)
+
+    text = RESPONSE_CACHE.get(key)
+    if text is not None:
+        return text
+
+    async def generate_and_cache():
+        model = resolve_model(model_name, system_instruction)
+        result = await call_gemini(model, prompt)
+        text = result.text
+
+        RESPONSE_CACHE[key] = text
+        return text
+
+    return await single_flight(key, generate_and_cache)
+
+
+def resolve_model(model_name, system_instruction=None):
+    if system_instruction is None:
+        return get_model(model_name)
+    return get_instructed_model(model_name, system_instruction)
+
+
+async def stream_generate(model_name, prompt, system_instruction=None):
+    key = response_cache_key(model_name, prompt, system_instruction)
+
+    cached = RESPONSE_CACHE.get(key)
+    if cached is not None:
+        async def cached_chunks():
+            yield cached
+
+        return cached_chunks()
+
+    # Awaiting the stream waits for the first chunk, so upstream errors
+    # surface here (where callers can still fall back) rather than
+    # halfway through the response body. The concurrency slot is held
+    # until the stream has been fully relayed or abandoned.
+    model = resolve_model(model_name, system_instruction)
+    response = await call_gemini(model, prompt, keep_slot=True, stream=True)
+
+    released = False
+
+    def release_slot():
+        nonlocal released
+        if not released:
+            released = True
+            GEMINI_SEM.release()
+
+    async def chunks():
+        pieces = []
+        finish_reason = None
+
+        try:
+            async for chunk in response:
+                # Walk the parts once ourselves; chunk.text re-reads
+                # candidates and parts on every access.
+                candidates = chunk.candidates
+                if candidates:
+                    finish_reason = candidates[0].finish_reason
+                parts = chunk.parts if candidates else ()
+                text = "".join(part.text for part in parts)
+                if text:
+                    pieces.append(text)
+                    yield text
+        finally:
+            release_slot()
+
+        # Cache only output the model finished normally; a stream cut off
+        # by SAFETY or MAX_TOKENS, or one with no text, must not be
+        # replayed to later callers.
+        output = "".join(pieces)
+        if output and finish_reason == FINISH_REASON_STOP:
+            RESPONSE_CACHE[key] = output
+
+    gen = chunks()
+    # A generator dropped before it starts never runs its finally.
+    weakref.finalize(gen, release_slot)
+    return gen
+
+
+async def text_stream(chunks):
+    # Headers are already sent once the body starts, so an upstream
+    # failure can only end the body early.
+    try:
+        async for text in chunks:
+            yield text
+    except Exception as e:
+        print("Stream error:", e)
+    finally:
+        # Closing the inner stream releases its Gemini slot right away
+        # when the client disconnects mid-response.
+        await chunks.aclose()
+
+
+async def sse_events(chunks):
+    try:
+        async for text in chunks:
+            yield b"data: " + orjson.dumps({"delta": text}) + b"\n\n"
+    except Exception as e:
+        print("Stream error:", e)
+        yield b'event: error\ndata: {"error":"Stream interrupted"}\n\n'
+        return
+    finally:
+        await chunks.aclose()
+
+    yield b"event: done\ndata: {}\n\n"
+
+
+async def read_json():
+    try:
+        data = orjson.loads(await request.get_data())
+    except orjson.JSONDecodeError:
+        return None
+
+    # Every endpoint expects a JSON object at the top level.
+    return data if isinstance(data, dict) else None
+
+
+@app.errorhandler(GeminiBusy)
+async def gemini_busy(e):
+    if e.status == 503:
+        message = "Server busy, retry shortly"
+    else:
+        message = "Too many requests, retry shortly"
+
+    return jsonify({"error": message}), e.status, {
+        "Retry-After": str(RETRY_AFTER_SECONDS)
+    }
+
+
+@app.before_serving
+async def warmup():
+    # Build the shared gRPC aio client inside the serving loop (where its
+    # channel has to live) and open a pooled connection to Sapling, so the
+    # first user request doesn't pay for either.
+    genai_client.get_default_generative_async_client()
+
+    try:
+        # No key, so this costs no Sapling quota; it only sets up
+        # DNS, TCP and TLS for the keep-alive pool. The short timeout
+        # keeps an unreachable Sapling from holding up startup.
+        await sapling_client.head(SAPLING_URL, timeout=2)
+    except httpx.HTTPError as e:
+        print("Sapling warmup failed:", e)
+
+
+@app.after_serving
+async def close_clients():
+    await sapling_client.aclose()
+
 
 @app.route("/generate", methods=["POST"])
-def generate():
-    data = request.get_json(silent=True)
+async def generate():
+    data = await read_json()
 
     if not data:
-        return jsonify({"error": "Request body must be JSON"}), 400
+        return error_response(ERR_NOT_JSON)
 
     prompt = data.get("prompt")
     ai_model_key = data.get("ai_model")
 
-    if not prompt:
-        return jsonify({"error": "Missing 'prompt'"}), 400
+    if not isinstance(prompt, str) or not prompt.strip():
+        return error_response(ERR_MISSING_PROMPT)
 
-    if ai_model_key not in MODEL_REGISTRY:
+    if len(prompt) > MAX_PROMPT_CHARS:
         return jsonify({
-            "error": "Invalid 'ai_model'",
-            "allowed_values": list(MODEL_REGISTRY.keys())
-        }), 400
+            "error": "'prompt' too long",
+            "max_chars": MAX_PROMPT_CHARS
+        }), 413
+
+    if not isinstance(ai_model_key, str) or ai_model_key not in MODEL_KEYS:
+        return error_response(ERR_INVALID_MODEL)
+
+    model_name = MODEL_REGISTRY[ai_model_key]
+
+    if data.get("stream"):
+        model_used = ai_model_key
+        try:
+            chunks = await stream_generate(model_name, prompt)
+        except GeminiBusy:
+            raise
+        except Exception as e:
+            if not should_fall_back(ai_model_key, e):
+                return jsonify({"error": "Generation failed"}), 500
+            model_used = "flash_fallback"
+            try:
+                chunks = await stream_generate(FALLBACK_MODEL, prompt)
+            except GeminiBusy:
+                raise
+            except Exception:
+                return jsonify({"error": "Generation failed"}), 500
+
+        return Response(
+            text_stream(chunks),
+            mimetype="text/plain",
+            headers={"X-Model-Used": model_used}
+        )
 
     try:
-        model_name = MODEL_REGISTRY[ai_model_key]
-        model = genai.GenerativeModel(model_name)
-        result = model.generate_content(prompt)
+        output = await cached_generate(model_name, prompt)
 
         return jsonify({
             "model_used": ai_model_key,
-            "output": result.text
+            "output": output
         }), 200
 
+    except GeminiBusy:
+        raise
     except Exception as e:
-        if ai_model_key == "pro":
-            fallback_model = genai.GenerativeModel(
-                "models/gemini-2.5-flash"
-            )
-            result = fallback_model.generate_content(prompt)
-            return jsonify({
-                "model_used": "flash_fallback",
-                "output": result.text
-            }), 200
+        if not should_fall_back(ai_model_key, e):
+            return jsonify({"error": "Generation failed"}), 500
 
+    try:
+        output = await cached_generate(FALLBACK_MODEL, prompt)
+    except GeminiBusy:
+        raise
+    except Exception:
         return jsonify({"error": "Generation failed"}), 500
 
+    return jsonify({
+        "model_used": "flash_fallback",
+        "output": output
+    }), 200
+
 
 @app.route("/health", methods=["GET"])
-def health():
+async def health():
     return jsonify({"status": "ok"}), 200
 
 
-@app.route("/score", methods=["POST"])
-def score():
-    data = request.get_json(silent=True)
+# Texts shorter than this are scored 0 without asking Sapling.
+MIN_SCORE_CHARS = 50
 
-    if not data or "text" not in data:
-        return jsonify({"error": "Missing 'text'"}), 400
+SCORE_CACHE = TTLCache(maxsize=50_000, ttl=86400)
 
-    text = data["text"]
 
-    tried_keys = set()
+async def sapling_score(text):
+    if len(text) < MIN_SCORE_CHARS:
+        return 0
 
-    for _ in range(len(sapling_keys)):
-        key = next(sapling_cycle)
+    cache_key = hashlib.sha256(text.encode()).digest()
 
-        if key in tried_keys:
-            continue
-        tried_keys.add(key)
+    cached = SCORE_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
 
+    start = next(sapling_offsets)
+
+    for key in SAPLING_KEYS[start:] + SAPLING_KEYS[:start]:
         try:
-            response = requests.post(
-                "https://api.sapling.ai/api/v1/aidetect",
-                json={"key": key, "text": text},
-                timeout=5
+            response = await sapling_client.post(
+                SAPLING_URL,
+                json={"key": key, "text": text}
             )
             response.raise_for_status()
 
             result = response.json()
-            raw_score = result.get("score")
+            raw_score = result.get("score") if isinstance(result, dict) else None
 
-            if raw_score is None:
+            if (
+                not isinstance(raw_score, (int, float))
+                or isinstance(raw_score, bool)
+            ):
                 continue
 
             ai_score = int(raw_score * 100)
 
-            return jsonify({"score": ai_score}), 200
+            SCORE_CACHE[cache_key] = ai_score
+            return ai_score
 
-        except requests.exceptions.RequestException:
+        # httpx raises a plain json.JSONDecodeError (a ValueError) for a
+        # non-JSON body; treat it like any other failed key.
+        except (httpx.HTTPError, ValueError):
             continue
 
-    return jsonify({"error": "All Sapling keys failed"}), 500
+    return None
 
-    
 
-def build_editor_prompt(content, audience, tone, purpose, length_change):
-    return f"""
+MAX_BATCH_TEXTS = 100
+SAPLING_CONCURRENCY = 16
+
+
+async def score_many(texts):
+    if (
+        not isinstance(texts, list)
+        or not texts
+        or not all(isinstance(text, str) for text in texts)
+    ):
+        return jsonify({"error": "Missing 'texts'"}), 400
+
+    if len(texts) > MAX_BATCH_TEXTS:
+        return jsonify({
+            "error": "Too many 'texts'",
+            "max_items": MAX_BATCH_TEXTS
+        }), 400
+
+    # Sapling has no batch endpoint, so fan out with a cap on how many
+    # requests we hold open against it at once.
+    sem = asyncio.Semaphore(SAPLING_CONCURRENCY)
+
+    # One text failing must not fail the batch (gather would propagate
+    # the first exception), so anything unexpected becomes a null score.
+    async def one(text):
+        async with sem:
+            try:
+                return await sapling_score(text)
+            except Exception as e:
+                print("Score error:", e)
+                return None
+
+    scores = await asyncio.gather(*[one(text) for text in texts])
+
+    if all(s is None for s in scores):
+        return jsonify({"error": "All Sapling keys failed"}), 500
+
+    # Texts that could not be scored come back as null.
+    return jsonify({"scores": scores}), 200
+
+
+@app.route("/score", methods=["POST"])
+async def score():
+    data = await read_json()
+
+    # {"texts": [...]} scores a batch, same as /score_batch.
+    if data and "texts" in data:
+        return await score_many(data["texts"])
+
+    if not data or not isinstance(data.get("text"), str):
+        return jsonify({"error": "Missing 'text'"}), 400
+
+    ai_score = await sapling_score(data["text"])
+
+    if ai_score is None:
+        return jsonify({"error": "All Sapling keys failed"}), 500
+
+    return jsonify({"score": ai_score}), 200
+
+
+@app.route("/score_batch", methods=["POST"])
+async def score_batch():
+    data = await read_json()
+
+    return await score_many(data.get("texts") if data else None)
+
+
+HUMANIZER_PREAMBLE = """
 You are NOT an AI assistant. You are a human writer with a distinct, slightly imperfect voice. 
 Your GOAL: Rewrite the text to bypass AI detection by maximizing 'Perplexity' and 'Burstiness' while mimicking human cognitive noise.
 
@@ -147,73 +639,187 @@ To do this, you must aggressively violate standard AI writing patterns.
    - Humans tend to tell / explain concepts by taking reference from their own life experiences.
    - Humans tend to use easy grammar words, not the complex and rare ones.
 
-### INPUT CONTEXT:
-- Audience: {audience}
-- Tone: {tone} (Apply this tone, but keep it "raw" and "unpolished")
-- Purpose: {purpose}
-- Length Strategy: {length_change}
-
-### TEXT TO REWRITE:
-{content}
-
 ### OUTPUT INSTRUCTION:
 Return ONLY the rewritten text. Do not output "Here is the text" or any intro. 
 Just the raw, human-sounding content.
 """.strip()
 
-@app.route("/humanize", methods=["POST"])
-def humanize():
-    data = request.get_json(silent=True)
 
+# Fixed pieces of the per-request prompt, joined around the user fields
+# in build_editor_prompt() instead of re-formatting one big template.
+_PROMPT_AUDIENCE = "### INPUT CONTEXT:\n- Audience: "
+_PROMPT_TONE = "\n- Tone: "
+_PROMPT_PURPOSE = ' (Apply this tone, but keep it "raw" and "unpolished")\n- Purpose: '
+_PROMPT_LENGTH = "\n- Length Strategy: "
+_PROMPT_CONTENT = "\n\n### TEXT TO REWRITE:\n"
+
+
+@functools.lru_cache(maxsize=64)
+def build_prompt_header(audience, tone, purpose, length_change):
+    # Clients draw these from a handful of presets, so the header is
+    # nearly always a cache hit.
+    return "".join((
+        _PROMPT_AUDIENCE, audience,
+        _PROMPT_TONE, tone,
+        _PROMPT_PURPOSE, purpose,
+        _PROMPT_LENGTH, length_change,
+        _PROMPT_CONTENT
+    ))
+
+
+def build_editor_prompt(content, audience, tone, purpose, length_change):
+    # Only the per-request part; the rules travel as HUMANIZER_PREAMBLE.
+    return build_prompt_header(
+        audience, tone, purpose, length_change
+    ) + content.rstrip()
+
+
+# Returns (prompt, ai_model_key, None), or (None, None, error_response)
+# when the body is rejected.
+def parse_humanize_request(data):
     if not data or "content" not in data:
-        return jsonify({"error": "Missing 'content'"}), 400
+        return None, None, error_response(ERR_MISSING_CONTENT)
 
     content = data["content"]
 
+    if not isinstance(content, str) or not content.strip():
+        return None, None, error_response(ERR_MISSING_CONTENT)
+
+    if len(content) > MAX_PROMPT_CHARS:
+        return None, None, (jsonify({
+            "error": "'content' too long",
+            "max_chars": MAX_PROMPT_CHARS
+        }), 413)
+
+    content = normalize_text(content)
+
+    constraints = data.get("constraints") or {}
+    if not isinstance(constraints, dict):
+        return None, None, (jsonify({"error": "Invalid 'constraints'"}), 400)
+
     audience = data.get("audience", "general")
     tone = data.get("tone", "neutral")
     purpose = data.get("purpose", "explain")
-    length_change = data.get("constraints", {}).get("length_change", "minimal")
+    length_change = constraints.get("length_change", "minimal")
+
+    for field, value in (
+        ("audience", audience),
+        ("tone", tone),
+        ("purpose", purpose),
+        ("length_change", length_change)
+    ):
+        if not isinstance(value, str) or len(value) > MAX_CONTEXT_CHARS:
+            return None, None, (jsonify({
+                "error": f"Invalid '{field}'",
+                "max_chars": MAX_CONTEXT_CHARS
+            }), 400)
 
     ai_model_key = data.get("ai_model", "flash")
 
-    MODEL_REGISTRY = {
-        "flash": "models/gemini-2.5-flash",
-        "pro": "models/gemini-3-pro-preview"
-    }
+    if (
+        not isinstance(ai_model_key, str)
+        or ai_model_key not in HUMANIZE_MODEL_KEYS
+    ):
+        return None, None, error_response(ERR_INVALID_HUMANIZE_MODEL)
 
-    if ai_model_key not in MODEL_REGISTRY:
-        return jsonify({
-            "error": "Invalid 'ai_model'",
-            "allowed_values": list(MODEL_REGISTRY.keys())
-        }), 400
+    prompt = build_editor_prompt(
+        content=content,
+        audience=audience,
+        tone=tone,
+        purpose=purpose,
+        length_change=length_change
+    )
 
-    try:
-        prompt = build_editor_prompt(
-            content=content,
-            audience=audience,
-            tone=tone,
-            purpose=purpose,
-            length_change=length_change
-        )
+    return prompt, ai_model_key, None
 
-        model = genai.GenerativeModel(MODEL_REGISTRY[ai_model_key])
-        result = model.generate_content(prompt)
 
-        return jsonify({
-            "content": result.text
-        }), 200
+async def generate_humanized(prompt, ai_model_key):
+    try:
+        return await cached_generate(
+            HUMANIZE_MODEL_REGISTRY[ai_model_key], prompt, HUMANIZER_PREAMBLE
+        )
 
+    except GeminiBusy:
+        raise
     except Exception as e:
         print("Humanize error:", e)
 
-        if ai_model_key == "pro":
-            fallback_model = genai.GenerativeModel(
-                "models/gemini-2.5-flash"
+        if not should_fall_back(ai_model_key, e):
+            raise
+
+        return await cached_generate(
+            FALLBACK_MODEL, prompt, HUMANIZER_PREAMBLE
+        )
+
+
+@app.route("/humanize", methods=["POST"])
+async def humanize():
+    data = await read_json()
+
+    prompt, ai_model_key, error = parse_humanize_request(data)
+    if error:
+        return error
+
+    if data.get("stream"):
+        try:
+            chunks = await stream_generate(
+                HUMANIZE_MODEL_REGISTRY[ai_model_key], prompt, HUMANIZER_PREAMBLE
             )
-            result = fallback_model.generate_content(prompt)
-            return jsonify({
-                "content": result.text
-            }), 200
+        except GeminiBusy:
+            raise
+        except Exception as e:
+            print("Humanize error:", e)
+            if not should_fall_back(ai_model_key, e):
+                return jsonify({"error": "Humanization failed"}), 500
+            try:
+                chunks = await stream_generate(
+                    FALLBACK_MODEL, prompt, HUMANIZER_PREAMBLE
+                )
+            except GeminiBusy:
+                raise
+            except Exception:
+                return jsonify({"error": "Humanization failed"}), 500
+
+        return Response(
+            sse_events(chunks),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"}
+        )
+
+    try:
+        output = await generate_humanized(prompt, ai_model_key)
+    except GeminiBusy:
+        raise
+    except Exception:
+        return jsonify({"error": "Humanization failed"}), 500
+
+    return jsonify({
+        "content": output
+    }), 200
+
+
+@app.route("/humanize_and_score", methods=["POST"])
+async def humanize_and_score():
+    # Same body as /humanize; saves the client a second round-trip to
+    # /score by scoring the rewritten text here.
+    data = await read_json()
+
+    prompt, ai_model_key, error = parse_humanize_request(data)
+    if error:
+        return error
+
+    try:
+        output = await generate_humanized(prompt, ai_model_key)
+    except GeminiBusy:
+        raise
+    except Exception:
+        return jsonify({"error": "Humanization failed"}), 500
+
+    # A failed score still returns the rewritten text, with "score": null.
+    ai_score = await sapling_score(output)
+
+    return jsonify({
+        "content": output,
+        "score": ai_score
+    }), 200
 
-        return jsonify({"error": "Humanization failed"}), 500
\ No newline at end of file
@@ -0,0 +1,19 @@
+# gunicorn -c gunicorn_conf.py api.index:app
+#
+# The app is ASGI (Quart), so each worker runs an event loop through
+# uvicorn and keeps many Gemini/Sapling calls in flight concurrently.
+#
+# Every limit in api/index.py is per worker process: GEMINI_MAX_CONCURRENCY,
+# GEMINI_RPM, GEMINI_MAX_QUEUE, the response cache and request coalescing.
+# With N workers the upstream sees up to N times those limits, so keep N
+# small and divide the Gemini quota across workers when raising it.
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+# Uvicorn workers heartbeat from their event loop, so this only restarts a
+# worker whose loop has hung; it does not limit how long a request takes.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = 5